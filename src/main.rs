@@ -17,6 +17,16 @@ use clap::{AppSettings, Parser, Subcommand};
 // todo: investigate switching to: https://docs.rs/notify/latest/notify/
 const POLL_INTERVAL: u64 = 5;
 
+// CAT_BUFFER is the number of frames store_cat's reader thread may decode ahead of its
+// consumer, so reading and decoding frames overlaps with whatever the consumer does
+// with them. it's kept small as frames can be arbitrarily large: peak memory for a cat
+// is up to CAT_BUFFER decoded frames
+const CAT_BUFFER: usize = 32;
+
+// REQUEST and RESPONSE are the attributes call and serve use to mark their frames
+const REQUEST: &str = ".request";
+const RESPONSE: &str = ".response";
+
 #[derive(Parser, Debug)]
 #[clap(author, version, about, long_about = None)]
 #[clap(global_setting(AppSettings::DisableHelpSubcommand))]
@@ -84,7 +94,7 @@ struct ResponseFrame {
 
 fn main() {
     let params = Args::parse();
-    let env = store_open(std::path::Path::new(&params.path));
+    let store = store_open(std::path::Path::new(&params.path));
 
     match &params.command {
         Commands::Put { topic, attribute } => {
@@ -92,15 +102,20 @@ fn main() {
             std::io::stdin().read_to_string(&mut data).unwrap();
             println!(
                 "{}",
-                store_put(&env, topic.clone(), attribute.clone(), data)
+                store_put(&store, topic.clone(), attribute.clone(), data)
             );
         }
 
         Commands::Get { id } => {
             let id = scru128::Scru128Id::from_str(id).unwrap();
-            let frame = store_get(&env, id);
-            let frame = serde_json::to_string(&frame).unwrap();
-            println!("{}", frame);
+            // frames are stored as json, so the stored bytes are written out as is rather
+            // than being decoded and encoded again
+            let mut out = std::io::stdout().lock();
+            let found = store_get_raw(&store, id, |frame| out.write_all(frame).unwrap());
+            if found.is_none() {
+                out.write_all(b"null").unwrap();
+            }
+            out.write_all(b"\n").unwrap();
         }
 
         Commands::Cat {
@@ -108,36 +123,58 @@ fn main() {
             sse,
             last_id,
         } => {
+            // output is buffered, and flushed whenever we catch up with the stream, so
+            // large cats don't pay a write per frame while follows still see frames live
+            let mut out = std::io::BufWriter::new(std::io::stdout().lock());
+
             // send a comment to establish the connection
             if *sse {
-                println!(": welcome");
+                writeln!(out, ": welcome").unwrap();
             }
 
-            let env = std::sync::Arc::new(env);
-            let frames = store_cat(env.clone(), *last_id, *follow);
-            for frame in frames {
-                let data = serde_json::to_string(&frame).unwrap();
+            let store = std::sync::Arc::new(store);
+            let frames = store_cat(store.clone(), *last_id, *follow);
+            loop {
+                let frame = match frames.try_recv() {
+                    Ok(frame) => frame,
+                    Err(std::sync::mpsc::TryRecvError::Empty) => {
+                        out.flush().unwrap();
+                        match frames.recv() {
+                            Ok(frame) => frame,
+                            Err(_) => break,
+                        }
+                    }
+                    Err(std::sync::mpsc::TryRecvError::Disconnected) => break,
+                };
+
+                // frames are serialized straight into the output buffer, rather than
+                // into an intermediate String first
                 match sse {
                     true => {
-                        println!("id: {}", frame.id);
-                        println!("data: {}\n", data);
+                        write!(out, "id: {}\ndata: ", frame.id).unwrap();
+                        serde_json::to_writer(&mut out, &frame).unwrap();
+                        out.write_all(b"\n\n").unwrap();
                     }
 
-                    false => println!("{}", data),
+                    false => {
+                        serde_json::to_writer(&mut out, &frame).unwrap();
+                        out.write_all(b"\n").unwrap();
+                    }
                 }
             }
+            out.flush().unwrap();
         }
 
         Commands::Call { topic } => {
             let mut data = String::new();
             std::io::stdin().read_to_string(&mut data).unwrap();
 
-            let env = std::sync::Arc::new(env);
-            let id = store_put(&env, Some(topic.clone()), Some(".request".into()), data);
-            let frames = store_cat(env.clone(), Some(id), true);
+            let store = std::sync::Arc::new(store);
+            let id = store_put(&store, Some(topic.clone()), Some(REQUEST.into()), data);
+            let frames = store_cat(store.clone(), Some(id), true);
             let frames = frames.iter().filter(|frame| {
-                frame.topic == Some(topic.to_string())
-                    && frame.attribute == Some(".response".into())
+                frame.topic.as_deref() == Some(topic.as_str())
+                    && frame.attribute.as_deref() == Some(RESPONSE)
             });
             for frame in frames {
                 let response: ResponseFrame = serde_json::from_str(&frame.data).unwrap();
@@ -153,26 +190,24 @@ fn main() {
             command,
             args,
         } => {
-            let env = std::sync::Arc::new(env);
-
-            let last_id = store_cat(env.clone(), None, false)
-                .iter()
-                .filter(|frame| {
-                    frame.topic == Some(topic.to_string())
-                        && frame.attribute == Some(".response".into())
-                })
-                .last()
-                .and_then(|frame| {
-                    Some(
-                        serde_json::from_str::<ResponseFrame>(&frame.data)
-                            .unwrap()
-                            .source_id,
-                    )
-                });
-
-            let frames = store_cat(env.clone(), last_id, true);
+            let store = std::sync::Arc::new(store);
+
+            let last_id = store_last(&store, |frame| {
+                frame.topic.as_deref() == Some(topic.as_str())
+                    && frame.attribute.as_deref() == Some(RESPONSE)
+            })
+            .and_then(|frame| {
+                Some(
+                    serde_json::from_str::<ResponseFrame>(&frame.data)
+                        .unwrap()
+                        .source_id,
+                )
+            });
+
+            let frames = store_cat(store.clone(), last_id, true);
             let frames = frames.iter().filter(|frame| {
-                frame.topic == Some(topic.to_string()) && frame.attribute == Some(".request".into())
+                frame.topic.as_deref() == Some(topic.as_str())
+                    && frame.attribute.as_deref() == Some(REQUEST)
             });
 
             for frame in frames {
@@ -193,7 +228,7 @@ fn main() {
                     data: data,
                 };
                 let data = serde_json::to_string(&res).unwrap();
-                let _ = store_put(&env, Some(topic.clone()), Some(".response".into()), data);
+                let _ = store_put(&store, Some(topic.clone()), Some(RESPONSE.into()), data);
             }
         }
     }
@@ -243,35 +278,47 @@ fn parse_sse<R: Read>(buf: &mut BufReader<R>) -> Option<Event> {
     });
 }
 
-fn store_open(path: &std::path::Path) -> lmdb::Environment {
+// Store pairs the environment with its default database handle. opening the handle
+// runs a transaction of its own, so it's done once here rather than on every access
+struct Store {
+    env: lmdb::Environment,
+    db: lmdb::Database,
+}
+
+fn store_open(path: &std::path::Path) -> Store {
     std::fs::create_dir_all(path).unwrap();
     let env = lmdb::Environment::new()
         .set_map_size(10 * 10485760)
         .open(path)
         .unwrap();
-    return env;
+    let db = env.open_db(None).unwrap();
+    return Store { env: env, db: db };
 }
 
 fn store_put(
-    env: &lmdb::Environment,
+    store: &Store,
     topic: Option<String>,
     attribute: Option<String>,
-    data: String,
+    mut data: String,
 ) -> scru128::Scru128Id {
     let id = scru128::new();
 
+    // trim in place, rather than copying the trimmed slice into a new String
+    data.truncate(data.trim_end().len());
+    let start = data.len() - data.trim_start().len();
+    data.drain(..start);
+
     let frame = Frame {
         id: id,
-        topic: topic.clone(),
-        attribute: attribute.clone(),
-        data: data.trim().to_string(),
+        topic: topic,
+        attribute: attribute,
+        data: data,
     };
     let frame = serde_json::to_vec(&frame).unwrap();
 
-    let db = env.open_db(None).unwrap();
-    let mut txn = env.begin_rw_txn().unwrap();
+    let mut txn = store.env.begin_rw_txn().unwrap();
     txn.put(
-        db,
+        store.db,
         // if I understand the docs right, this should be 'to_ne_bytes', but that doesn't
         // work
         &id.to_u128().to_be_bytes(),
@@ -284,49 +331,90 @@ fn store_put(
     return id;
 }
 
-fn store_get(env: &lmdb::Environment, id: scru128::Scru128Id) -> Option<Frame> {
-    let db = env.open_db(None).unwrap();
-    let txn = env.begin_ro_txn().unwrap();
-    match txn.get(db, &id.to_u128().to_be_bytes()) {
-        Ok(value) => Some(serde_json::from_slice(&value).unwrap()),
+// store_get_raw calls f with the frame's stored json encoding, without decoding it. the
+// slice points directly into the memory map, so it's only valid for the duration of f
+fn store_get_raw<T, F>(store: &Store, id: scru128::Scru128Id, f: F) -> Option<T>
+where
+    F: FnOnce(&[u8]) -> T,
+{
+    let txn = store.env.begin_ro_txn().unwrap();
+    match txn.get(store.db, &id.to_u128().to_be_bytes()) {
+        Ok(value) => Some(f(value)),
         Err(lmdb::Error::NotFound) => None,
-        Err(err) => panic!("store_get: {:?}", err),
+        Err(err) => panic!("store_get_raw: {:?}", err),
+    }
+}
+
+// MDB_LAST and MDB_PREV are cursor operations from lmdb.h's MDB_cursor_op enum, for use
+// with Cursor::get. lmdb-rkv doesn't re-export its sys crate, so they're defined here
+// rather than taken from a different sys package than the one lmdb-rkv is built on
+const MDB_LAST: u32 = 6;
+const MDB_PREV: u32 = 12;
+
+// store_last scans the stream backwards from the most recent frame, returning the first
+// frame that matches predicate. this avoids reading the whole stream when only the
+// latest match is needed
+fn store_last<F>(store: &Store, predicate: F) -> Option<Frame>
+where
+    F: Fn(&Frame) -> bool,
+{
+    let txn = store.env.begin_ro_txn().unwrap();
+    let c = txn.open_ro_cursor(store.db).unwrap();
+    let mut op = MDB_LAST;
+    loop {
+        match c.get(None, None, op) {
+            Ok((_, value)) => {
+                let frame: Frame = serde_json::from_slice(&value).unwrap();
+                if predicate(&frame) {
+                    return Some(frame);
+                }
+            }
+            Err(lmdb::Error::NotFound) => return None,
+            Err(err) => panic!("store_last: {:?}", err),
+        }
+        op = MDB_PREV;
     }
 }
 
 fn store_cat(
-    env: std::sync::Arc<lmdb::Environment>,
+    store: std::sync::Arc<Store>,
     last_id: Option<scru128::Scru128Id>,
     follow: bool,
 ) -> std::sync::mpsc::Receiver<Frame> {
-    let (tx, rx) = std::sync::mpsc::sync_channel::<Frame>(0);
+    let (tx, rx) = std::sync::mpsc::sync_channel::<Frame>(CAT_BUFFER);
     std::thread::spawn(move || {
         let mut last_id = last_id;
-        let db = env.open_db(None).unwrap();
+        // a single read transaction is reused across polls: between polls it's reset,
+        // releasing its snapshot, and renewed to pick up new writes. this keeps the
+        // reader slot rather than setting up and tearing down a transaction each poll
+        let mut txn = store.env.begin_ro_txn().unwrap();
         loop {
-            let txn = env.begin_ro_txn().unwrap();
-            let mut c = txn.open_ro_cursor(db).unwrap();
-            let it = match last_id {
-                Some(key) => {
-                    let mut i = c.iter_from(&key.to_u128().to_be_bytes());
-                    i.next();
-                    i
-                }
-                None => c.iter_start(),
-            };
+            {
+                let mut c = txn.open_ro_cursor(store.db).unwrap();
+                let it = match last_id {
+                    Some(key) => {
+                        let mut i = c.iter_from(&key.to_u128().to_be_bytes());
+                        i.next();
+                        i
+                    }
+                    None => c.iter_start(),
+                };
 
-            for item in it {
-                let (_, value) = item.unwrap();
-                let frame: Frame = serde_json::from_slice(&value).unwrap();
-                last_id = Some(frame.id);
-                if tx.send(frame).is_err() {
-                    return;
+                for item in it {
+                    let (_, value) = item.unwrap();
+                    let frame: Frame = serde_json::from_slice(&value).unwrap();
+                    last_id = Some(frame.id);
+                    if tx.send(frame).is_err() {
+                        return;
+                    }
                 }
             }
             if !follow {
                 break;
             }
+            let inactive = txn.reset();
             std::thread::sleep(std::time::Duration::from_millis(POLL_INTERVAL));
+            txn = inactive.renew().unwrap();
         }
     });
     rx
@@ -342,12 +430,13 @@ mod tests {
     #[test]
     fn test_store() {
         let d = TempDir::new().unwrap();
-        let env = std::sync::Arc::new(store_open(&d.path()));
+        let store = std::sync::Arc::new(store_open(&d.path()));
 
-        let id = store_put(&env, None, None, "foo".into());
-        assert_eq!(store_cat(env.clone(), None, false).iter().count(), 1);
+        let id = store_put(&store, None, None, "foo".into());
+        assert_eq!(store_cat(store.clone(), None, false).iter().count(), 1);
 
-        let frame = store_get(&env, id).unwrap();
+        let frame: Frame =
+            store_get_raw(&store, id, |value| serde_json::from_slice(value).unwrap()).unwrap();
         assert_eq!(
             frame,
             Frame {
@@ -358,18 +447,50 @@ mod tests {
             }
         );
 
+        assert_eq!(
+            store_get_raw(&store, id, |value| value.to_vec()).unwrap(),
+            serde_json::to_vec(&frame).unwrap()
+        );
+        assert_eq!(store_get_raw(&store, scru128::new(), |_| ()), None);
+
         // skip with last_id
-        assert_eq!(store_cat(env.clone(), Some(id), false).iter().count(), 0);
+        assert_eq!(store_cat(store.clone(), Some(id), false).iter().count(), 0);
+
+        // data is trimmed
+        let id = store_put(&store, None, None, " \tbar\n".into());
+        let frame: Frame =
+            store_get_raw(&store, id, |value| serde_json::from_slice(value).unwrap()).unwrap();
+        assert_eq!(frame.data, "bar");
+    }
+
+    #[test]
+    fn test_store_last() {
+        let d = TempDir::new().unwrap();
+        let store = store_open(&d.path());
+
+        assert_eq!(store_last(&store, |_| true), None);
+
+        let id1 = store_put(&store, Some("foo".into()), None, "1".into());
+        let id2 = store_put(&store, Some("foo".into()), None, "2".into());
+        let _ = store_put(&store, Some("bar".into()), None, "3".into());
+
+        let frame = store_last(&store, |frame| frame.topic == Some("foo".into())).unwrap();
+        assert_eq!(frame.id, id2);
+
+        let frame = store_last(&store, |frame| frame.data == "1").unwrap();
+        assert_eq!(frame.id, id1);
+
+        assert_eq!(store_last(&store, |frame| frame.data == "4"), None);
     }
 
     #[test]
     fn test_store_cat_follow() {
         let d = TempDir::new().unwrap();
-        let env = std::sync::Arc::new(store_open(&d.path()));
+        let store = std::sync::Arc::new(store_open(&d.path()));
 
-        let rx = store_cat(env.clone(), None, true);
+        let rx = store_cat(store.clone(), None, true);
 
-        let id = store_put(&env, None, None, "foo".into());
+        let id = store_put(&store, None, None, "foo".into());
         assert_eq!(rx.recv().unwrap().id, id);
 
         // no updates
@@ -378,13 +499,13 @@ mod tests {
             .is_err());
 
         // an update
-        let id = store_put(&env, None, None, "foo".into());
+        let id = store_put(&store, None, None, "foo".into());
         assert_eq!(rx.recv().unwrap().id, id);
 
         // check sender cleanly stops
         drop(rx);
 
-        let _ = store_put(&env, None, None, "foo".into());
+        let _ = store_put(&store, None, None, "foo".into());
         std::thread::sleep(std::time::Duration::from_millis(20));
     }
 